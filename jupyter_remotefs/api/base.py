@@ -1,4 +1,6 @@
 from notebook.base.handlers import APIHandler
+from tornado.httpclient import AsyncHTTPClient
+from ..download import create_http_client
 
 
 class RemoteFSBaseHandler(APIHandler):
@@ -7,4 +9,9 @@ class RemoteFSBaseHandler(APIHandler):
             raise NotImplementedError()
         super().__init__(*args, **kwargs)
 
-    pass
+    @property
+    def http_client(self) -> AsyncHTTPClient:
+        """Http client shared between all requests to the extension."""
+        if 'remotefs_http_client' not in self.settings:
+            self.settings['remotefs_http_client'] = create_http_client()
+        return self.settings['remotefs_http_client']
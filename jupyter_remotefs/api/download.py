@@ -1,14 +1,20 @@
 import json
+import logging
+import os.path
+from tempfile import TemporaryDirectory
+from notebook.services.contents.filemanager import FileContentsManager
 from tornado import gen, web
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-from ..download import download_as_model, unzip_as_model
+from ..download import (download_and_extract_zip, download_as_model,
+                        download_to_file, extract_zip, remove_download,
+                        run_blocking, stream_unzip, unzip_as_model,
+                        zip_download_path)
 from .base import RemoteFSBaseHandler
 
 
 class RemoteFSDownloadHandler(RemoteFSBaseHandler):
-    @gen.coroutine
     @web.authenticated
-    def post(self, *args, **kwargs):
+    async def post(self, *args, **kwargs):
         parameters = json.loads(self.request.body)
         try:
             url = parameters['remote_url']
@@ -18,35 +24,89 @@ class RemoteFSDownloadHandler(RemoteFSBaseHandler):
                 {'message': "malformed request"}))
         headers = parameters['headers'] if 'headers' in parameters else None
         unzip = parameters['unzip'] if 'unzip' in parameters else 'none'
+        parallel_deflate = (parameters['parallel_deflate']
+                            if 'parallel_deflate' in parameters else False)
+        verify = parameters['verify'] if 'verify' in parameters else True
         if unzip == "auto":
             unzip = "zip" if url.endswith(".zip") else "none"
+        # file-backed contents managers are bypassed and written to directly
+        file_backed = isinstance(self.contents_manager, FileContentsManager)
         if unzip == "none":
-            model = yield download_as_model(url, path=path, headers=headers)
-            self.contents_manager.save(model, path=path)
+            if file_backed:
+                # skip the Contents API (and its base64 round trip) entirely
+                # and stream the download straight onto disk
+                await download_to_file(
+                    url, headers=headers, http_client=self.http_client,
+                    local_path=self.contents_manager._get_os_path(path))
+            else:
+                model = await download_as_model(
+                    url, path=path, headers=headers,
+                    http_client=self.http_client)
+                self.contents_manager.save(model, path=path)
             self.finish(json.dumps({"message": "ok"}))
         elif unzip == "zip":
-            zipped_model = yield download_as_model(
-                url, path=path + ".zip", headers=headers)
-            model = unzip_as_model(zipped_model, model_path=path)
-            yield gen.maybe_future(self.save_unzipped_model(model))
+            # extracting while downloading doesn't support the extraction
+            # options (or resuming the download), so is only done if they
+            # aren't asked for
+            streamed = (stream_unzip is not None and verify and
+                        not parallel_deflate)
+            if file_backed and streamed:
+                # extract the archive while it is still being downloaded
+                await download_and_extract_zip(
+                    url, headers=headers, http_client=self.http_client,
+                    directory=self.contents_manager._get_os_path(path))
+            elif file_backed:
+                # download the archive next to where it will be extracted and
+                # stream its members straight onto disk
+                os_path = self.contents_manager._get_os_path(path)
+                zip_path = zip_download_path(
+                    os_path, root_dir=self.contents_manager.root_dir)
+                await download_to_file(
+                    url, local_path=zip_path, headers=headers,
+                    http_client=self.http_client)
+                await run_blocking(extract_zip, zip_path, os_path,
+                                   parallel_deflate=parallel_deflate,
+                                   verify=verify)
+                # the archive is only removed once it has been extracted, so
+                # that retrying a failed extraction can revalidate it rather
+                # than downloading it again, and pick up where it left off
+                remove_download(zip_path)
+            else:
+                with TemporaryDirectory() as temp_dir:
+                    zip_path = os.path.join(temp_dir, 'download.zip')
+                    await download_to_file(
+                        url, local_path=zip_path, headers=headers,
+                        http_client=self.http_client)
+                    model = await run_blocking(
+                        unzip_as_model, zip_path, model_path=path)
+                await self.save_unzipped_model(model)
             self.finish(json.dumps({"message": "ok"}))
         else:
             raise web.HTTPError(400, json.dumps(
                 {'message': f"invalid unzip value: {unzip}"}))
 
-    @gen.coroutine
-    def save_unzipped_model(self, model):
-        """Save a model in the format returned by unzip_as_model."""
-        if model["type"] == "directory":
-            children = model["content"]
-            del model["content"]
-            print(f"remotefs: saving directory {model['path']}")
-            print("remotefs: children:", *[child['path'] for child in children])
-            yield gen.maybe_future(self.contents_manager.save(model, path=model["path"]))
-            for child in children:
-                yield gen.maybe_future(self.save_unzipped_model(child))
-        else:
-            # model["type"] == "file"
-            #print(f"saving file {model['path']}")
-            yield gen.maybe_future(self.contents_manager.save(model, path=model["path"]))
+    async def save_unzipped_model(self, model):
+        """
+        Save a model in the format returned by unzip_as_model.
 
+        The tree is walked iteratively (depth first, so every directory is
+        saved before its contents) rather than recursively.
+        """
+        pending = [model]
+        while pending:
+            model = pending.pop()
+            if model["type"] == "directory":
+                children = model.pop("content")
+                self.log.debug("remotefs: saving directory %s", model['path'])
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug(
+                        "remotefs: children: %s",
+                        " ".join(child['path'] for child in children))
+                await gen.maybe_future(
+                    self.contents_manager.save(model, path=model["path"]))
+                # reversed so that children are popped (and saved) in order
+                pending.extend(reversed(children))
+            else:
+                # model["type"] == "file"
+                await gen.maybe_future(
+                    self.contents_manager.save(model, path=model["path"]))
@@ -1,23 +1,749 @@
-import base64
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait
+import collections
+import errno
+import functools
+import gzip
+import json
+import mmap
 import os.path
 from os.path import basename
-from typing import List
-from zipfile import ZipFile
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+import tornado
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient, HTTPResponse
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.httpclient import (AsyncHTTPClient, HTTPClientError, HTTPRequest,
+                                HTTPResponse)
+from tornado.httputil import HTTPHeaders
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 
+try:
+    # SIMD accelerated drop-in replacement for base64
+    import pybase64 as base64
+except ImportError:
+    import base64
 
-@gen.coroutine
-def download_as_model(url, *,
-                      path: str,
-                      headers: dict) -> dict:
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+try:
+    from stream_unzip import stream_unzip
+except ImportError:
+    stream_unzip = None
+
+# maximum number of simultaneous requests made by a download http client
+MAX_CLIENTS = 32
+# tornado's http clients limit bodies to 100MB by default, even when they are
+# streamed
+MAX_BODY_SIZE = 1 << 40
+CONNECT_TIMEOUT = 20
+# large downloads legitimately take longer than tornado's default 20 second
+# request timeout
+REQUEST_TIMEOUT = 60 * 60
+# size of the buffer used when writing downloaded data to disk
+WRITE_BUFFER_SIZE = 1 << 20
+# files smaller than this are never split into segments, since the extra
+# requests would cost more than they gain
+MIN_SEGMENTED_SIZE = 16 << 20
+# zip members up to this size are extracted with a single write rather than
+# being streamed
+SMALL_MEMBER_SIZE = 1 << 20
+# deflated zip members at least this big are considered for being inflated
+# by several threads at once
+PARALLEL_DEFLATE_MIN_SIZE = 64 << 20
+# (approximate) amount of compressed data inflated by each thread at a time
+DEFLATE_REGION_SIZE = 4 << 20
+# regions that inflate to more than this (ie. very compressible data) are
+# inflated serially instead, since each thread holds all of its region's
+# output in memory
+MAX_INFLATED_REGION_SIZE = 64 << 20
+# an empty stored deflate block, as emitted by a (full) flush; the next block
+# starts on the following byte
+DEFLATE_FLUSH_MARKER = b'\x00\x00\xff\xff'
+# without this, os.open() translates newlines on windows
+_O_BINARY = getattr(os, 'O_BINARY', 0)
+# content encodings that a server might apply to a download without being
+# asked to
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+# downloaded data that a streamed extraction hasn't caught up with yet is
+# spilled to disk past this much
+MAX_BUFFERED_CHUNKS_SIZE = 64 << 20
+# text responses larger than this are saved as base64 models rather than
+# being decoded into a (potentially huge) string
+MAX_TEXT_MODEL_SIZE = 1 << 20
+
+
+# pool for blocking work (such as zip extraction) which mustn't be done on the
+# IOLoop
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def run_blocking(func, *args, **kwargs) -> Future:
+    """
+    Run a blocking function on a worker thread, leaving the IOLoop free to
+    handle other requests (and other downloads' streaming callbacks).
+    """
+    return IOLoop.current().run_in_executor(
+        _executor, functools.partial(func, *args, **kwargs))
+
+
+def create_http_client() -> AsyncHTTPClient:
+    """
+    Create a new http client to make downloads with.
+
+    pycurl's client is used if pycurl is installed since, unlike tornado's
+    simple client, it keeps connections alive between requests, so repeated
+    downloads from the same host don't pay for a new TCP and TLS handshake
+    each time.
+
+    Unlike the shared AsyncHTTPClient instance, the client has no limit on
+    the size of (streamed) response bodies worth mentioning.
+    """
+    if pycurl is not None:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        if tornado.version_info < (6, 5):
+            # before 6.5, the curl client doesn't limit body sizes at all
+            return CurlAsyncHTTPClient(force_instance=True,
+                                       max_clients=MAX_CLIENTS)
+        return CurlAsyncHTTPClient(force_instance=True,
+                                   max_clients=MAX_CLIENTS,
+                                   max_body_size=MAX_BODY_SIZE)
+    return SimpleAsyncHTTPClient(force_instance=True, max_clients=MAX_CLIENTS,
+                                 max_body_size=MAX_BODY_SIZE)
+
+
+def _sidecar_path(local_path: str, suffix: str) -> str:
+    """
+    Get the path of a hidden file that lives next to local_path.
+
+    Example. _sidecar_path('foo/bar.csv', 'part') -> 'foo/.bar.csv.part'
+    """
+    directory, filename = os.path.split(local_path)
+    return os.path.join(directory, f".{filename}.{suffix}")
+
+
+def zip_download_path(directory: str, root_dir: str = None) -> str:
+    """
+    Get the path to download a zip file to before extracting it into
+    directory.
+
+    The archive is kept next to the directory (rather than in a temporary
+    directory) so that, if extraction fails, retrying it can revalidate the
+    archive instead of downloading it again. When directory is root_dir,
+    the archive is kept inside it instead, as nothing should be written
+    outside of the root.
+    """
+    if (root_dir is not None and
+            os.path.normpath(directory) == os.path.normpath(root_dir)):
+        return os.path.join(directory, '.remotefs.zip')
+    return _sidecar_path(os.path.normpath(directory), 'zip')
+
+
+def _read_metadata(local_path: str) -> dict:
+    """Read the metadata stored about a (partial) download of local_path."""
+    try:
+        with open(_sidecar_path(local_path, 'remotefs'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(local_path: str, metadata: dict):
+    """Store metadata about a (partial) download of local_path."""
+    metadata_path = _sidecar_path(local_path, 'remotefs')
+    # written next to the metadata and moved into place, so that an
+    # interruption never leaves the metadata half written
+    temp_path = metadata_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(temp_path, metadata_path)
+
+
+def _finish_download(local_path: str, metadata: dict):
+    """
+    Move a completed partial download into place.
+
+    Downloads are requested without transparent decompression (so that byte
+    ranges refer to what is actually written to disk, and so that the IOLoop
+    isn't busy decompressing), so a server that gzips the file anyway is
+    dealt with here. This blocks, so should be called with run_blocking().
+
+    If the server gave us a validator for the file, it is kept (along with
+    the size and modification time of the file it describes) so the file can
+    be revalidated instead of downloaded again.
+    """
+    part_path = _sidecar_path(local_path, 'part')
+    if metadata.get('content_encoding') in GZIP_ENCODINGS:
+        _gunzip_file(part_path)
+    os.replace(part_path, local_path)
+    if metadata.get('etag') or metadata.get('last_modified'):
+        stat = os.stat(local_path)
+        _write_metadata(local_path, {**metadata,
+                                     'size': stat.st_size,
+                                     'mtime_ns': stat.st_mtime_ns})
+    else:
+        _remove_if_exists(_sidecar_path(local_path, 'remotefs'))
+
+
+def remove_download(local_path: str):
+    """Remove a downloaded file along with the metadata stored about it."""
+    _remove_if_exists(local_path)
+    _remove_if_exists(_sidecar_path(local_path, 'remotefs'))
+
+
+def _gunzip_file(path: str):
+    """Decompress a gzipped file in place."""
+    decompressed_path = path + '.gunzip'
+    with gzip.open(path, 'rb') as src, \
+            open(decompressed_path, 'wb', buffering=0) as dst:
+        shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+    os.replace(decompressed_path, path)
+
+
+def _remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class _ResponseHeaderCollector:
+    """
+    Collect the status code and headers of a response via header_callback.
+
+    on_headers is called once all of the headers of a response have been
+    received but before any of its body is passed to on_chunk. Header blocks
+    of intermediate responses (eg. redirects) simply replace each other.
+
+    Pass streaming_callback as the request's streaming_callback: the curl
+    client queues header lines on the IOLoop but delivers the last of the
+    body straight away when a transfer finishes, so (especially for small
+    responses) body chunks can arrive before the headers have been handled.
+    They're held back until they have been.
+    """
+    def __init__(self, on_headers, on_chunk):
+        self.code = None
+        self.headers = HTTPHeaders()
+        self._on_headers = on_headers
+        self._on_chunk = on_chunk
+        self._complete = False
+        self._pending_chunks = []
+
+    def __call__(self, line: str):
+        if line.startswith('HTTP/'):
+            # status line, eg. "HTTP/1.1 206 Partial Content"
+            self.code = int(line.split()[1])
+            self.headers = HTTPHeaders()
+            self._complete = False
+        elif line.strip():
+            self.headers.parse_line(line)
+        else:
+            self._complete = True
+            self._on_headers(self)
+            pending_chunks, self._pending_chunks = self._pending_chunks, []
+            for chunk in pending_chunks:
+                self._on_chunk(chunk)
+
+    def streaming_callback(self, chunk: bytes):
+        if self._complete:
+            self._on_chunk(chunk)
+        else:
+            self._pending_chunks.append(chunk)
+
+
+def _capture_errors(callback, errors: list):
+    """
+    Wrap a header_callback or streaming_callback so that the exceptions it
+    raises are appended to errors.
+
+    An exception raised by a callback aborts the request with the simple
+    http client, but it reports it as a closed connection (HTTP 599), so the
+    real error has to be re-raised instead. The curl client only logs it and
+    carries on with the transfer, so once there is an error the callback
+    isn't called again, and the caller has to check errors even when the
+    request succeeds.
+    """
+    def wrapper(*args):
+        if errors:
+            return None
+        try:
+            return callback(*args)
+        except Exception as e:
+            errors.append(e)
+            raise
+    return wrapper
+
+
+def _preallocate(fd: int, length: int):
+    """
+    Allocate the space for a file of the given length up front.
+
+    This can take a while (glibc emulates fallocate by writing every block on
+    filesystems that don't support it, such as NFS), so should be called
+    with run_blocking(). Running out of space is raised here rather than
+    part way through the download.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    # the file will be sparse until it has been written
+    os.ftruncate(fd, length)
+
+
+class _SegmentsAbandoned(Exception):
+    """Raised to abort the requests of a segmented download."""
+
+
+def _write_all(fd: int):
+    """Create a streaming_callback that writes straight to fd."""
+    def write(chunk: bytes):
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fd, view):]
+    return write
+
+
+def _write_at(fd: int, offset: int):
+    """Create a streaming_callback that writes to fd starting at offset."""
+    def write(chunk: bytes):
+        nonlocal offset
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+            view = view[written:]
+    return write
+
+
+async def _download_segmented(url, *,
+                              part_path: str,
+                              headers: dict,
+                              segments: int,
+                              http_client: AsyncHTTPClient) -> HTTPHeaders:
+    """
+    Download url into part_path using several concurrent range requests.
+
+    Each segment is written directly into its position in a preallocated
+    file, so multiple connections can be used to fill a link that a single
+    TCP connection can't saturate.
+
+    :return: the headers of the file, or None (in which case part_path may
+        contain garbage) if the server doesn't support range requests, or
+        doesn't give a strong validator for the file, or the file is too small
+        to be worth splitting
+    """
+    head_response: HTTPResponse
+    head_response = await http_client.fetch(HTTPRequest(
+        url, method='HEAD', headers=headers,
+        decompress_response=False,
+        connect_timeout=CONNECT_TIMEOUT,
+        request_timeout=REQUEST_TIMEOUT), raise_error=False)
+    try:
+        length = int(head_response.headers.get('Content-Length', 0))
+    except ValueError:
+        length = 0
+    if (head_response.code != 200 or length < MIN_SEGMENTED_SIZE or
+            head_response.headers.get('Accept-Ranges') != 'bytes'):
+        return None
+
+    # make sure every segment comes from the same version of the file (weak
+    # etags can't be used with If-Range, and a compliant server would answer
+    # every segment with the whole file)
+    etag = head_response.headers.get('ETag')
+    validator = (etag if etag and not etag.startswith('W/') else
+                 head_response.headers.get('Last-Modified'))
+    if not validator:
+        return None
+    segment_headers = {**headers, 'If-Range': validator}
+    bounds = [length * i // segments for i in range(segments + 1)]
+
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    # set if any segment isn't answered with the range it asked for, in which
+    # case all of the segments are abandoned
+    ranges_ignored = False
+    callback_errors = []
+    try:
+        await run_blocking(_preallocate, fd, length)
+
+        async def fetch_segment(start: int, end: int):
+            """:return: the response, or the exception that the fetch raised"""
+            write = _write_at(fd, start)
+
+            def on_headers(response: _ResponseHeaderCollector):
+                nonlocal ranges_ignored
+                segment_etag = response.headers.get('ETag')
+                content_range = response.headers.get('Content-Range', '')
+                # a server that ignores If-Range may answer with a range of
+                # a different version of the file, which mustn't be spliced
+                # in with the others
+                if (response.code != 206 or
+                        not content_range.startswith(f'bytes {start}-') or
+                        content_range.rpartition('/')[2] != str(length) or
+                        (segment_etag is not None and segment_etag != etag)):
+                    ranges_ignored = True
+
+            def on_chunk(chunk: bytes):
+                if ranges_ignored:
+                    # never write a full (or wrong) body into the file, and
+                    # abort the request rather than download it
+                    raise _SegmentsAbandoned()
+                write(chunk)
+
+            response = _ResponseHeaderCollector(on_headers, on_chunk)
+            try:
+                return await http_client.fetch(HTTPRequest(
+                    url, headers={**segment_headers,
+                                  'Range': f'bytes={start}-{end - 1}'},
+                    header_callback=_capture_errors(response,
+                                                    callback_errors),
+                    streaming_callback=_capture_errors(
+                        response.streaming_callback, callback_errors),
+                    decompress_response=False,
+                    connect_timeout=CONNECT_TIMEOUT,
+                    request_timeout=REQUEST_TIMEOUT), raise_error=False)
+            except Exception as e:
+                return e
+
+        # every segment has to finish with fd before it is closed, so errors
+        # are only raised once they all have
+        responses = await gen.multi([
+            fetch_segment(start, end)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ])
+    finally:
+        os.close(fd)
+    if ranges_ignored:
+        return None
+    if callback_errors:
+        raise callback_errors[0]
+    for response in responses:
+        if isinstance(response, Exception):
+            raise response
+        if response.code != 206:
+            response.rethrow()
+            raise HTTPClientError(
+                response.code, 'server did not honour range request',
+                response=response)
+    return head_response.headers
+
+
+async def download_to_file(url, *,
+                           local_path: str,
+                           headers: dict,
+                           segments: int = 4,
+                           http_client: AsyncHTTPClient = None):
+    """
+    Download a file from a remote URL directly onto the local filesystem.
+
+    The response body is streamed into a hidden partial file next to
+    local_path as it arrives, and moved into place once the download has
+    completed, so the body is never held in memory in its entirety.
+
+    If a previous download of the same url was interrupted, the partial file
+    is resumed with a Range request (guarded by If-Range so that a changed
+    remote file is downloaded from scratch). Servers that don't support
+    range requests simply send the whole file again.
+
+    Fresh downloads of large files from servers that support range requests
+    are split into segments which are downloaded concurrently.
+
+    If local_path was previously downloaded from the same url (and hasn't
+    been modified since), the request is made conditional on the remote file
+    having changed, and nothing is downloaded if it hasn't.
+
+    :param url: remote url to download
+    :param local_path: filesystem path to download to
+    :param headers: dictionary of headers to include in request to url
+    :param segments: maximum number of concurrent requests to download the
+        file with
+    :param http_client: client to make the request with (defaults to the
+        shared AsyncHTTPClient instance)
+    :return: False if local_path was already up to date, otherwise True
+    """
+    if local_path.endswith('/'):
+        raise ValueError('in call to download_to_file(), local_path cannot '
+                         'end with a slash ("/")')
+    part_path = _sidecar_path(local_path, 'part')
+    metadata_path = _sidecar_path(local_path, 'remotefs')
+    request_headers = dict(headers) if headers is not None else {}
+    if http_client is None:
+        http_client = AsyncHTTPClient()
+
+    metadata = _read_metadata(local_path)
+    validator = metadata.get('etag') or metadata.get('last_modified')
+    offset = 0
+    if (os.path.exists(part_path) and metadata.get('url') == url and
+            metadata.get('accept_ranges') == 'bytes' and validator):
+        offset = os.path.getsize(part_path)
+    if offset:
+        request_headers['Range'] = f'bytes={offset}-'
+        request_headers['If-Range'] = validator
+
+    conditional = False
+    if not offset and metadata.get('url') == url and validator:
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            stat = None
+        if (stat is not None and stat.st_size == metadata.get('size') and
+                stat.st_mtime_ns == metadata.get('mtime_ns')):
+            conditional = True
+            if metadata.get('etag'):
+                request_headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                request_headers['If-Modified-Since'] = (
+                    metadata['last_modified'])
+
+    # a conditional request will most likely come back empty, so there's no
+    # point splitting it up
+    if (not offset and not conditional and segments > 1 and
+            hasattr(os, 'pwrite')):
+        try:
+            file_headers = await _download_segmented(
+                url, part_path=part_path, headers=request_headers,
+                segments=segments, http_client=http_client)
+        except BaseException:
+            # a segmented partial file has holes in it, so can't be resumed
+            _remove_if_exists(part_path)
+            _remove_if_exists(metadata_path)
+            raise
+        if file_headers is not None:
+            await run_blocking(_finish_download, local_path, {
+                'url': url,
+                'etag': file_headers.get('ETag'),
+                'last_modified': file_headers.get('Last-Modified'),
+                'accept_ranges': file_headers.get('Accept-Ranges'),
+                'content_encoding': file_headers.get('Content-Encoding'),
+            })
+            return True
+        # the segments may have been abandoned part way through, leaving
+        # holes in the partial file
+        _remove_if_exists(part_path)
+
+    # chunks are written straight to the file descriptor rather than through
+    # a buffered file object to avoid copying every chunk into the buffer.
+    # The file is opened before the request is made, so that local problems
+    # (eg. a missing directory) are reported as such
+    part_fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | _O_BINARY, 0o666)
+    write = None
+    stale = False
+    callback_errors = []
+    # until a new download starts, the metadata of a conditional request
+    # belongs to the complete local_path rather than to the partial file
+    partial_metadata = not conditional
+
+    def on_headers(response: _ResponseHeaderCollector):
+        nonlocal write, metadata, stale, partial_metadata
+        if response.code == 206:
+            etag = response.headers.get('ETag')
+            content_range = response.headers.get('Content-Range', '')
+            if ((etag is not None and etag != metadata.get('etag')) or
+                    not content_range.startswith(f'bytes {offset}-')):
+                # some servers ignore If-Range; don't splice a different
+                # version of the file onto what we already have
+                stale = True
+                return
+            # server honoured the range, so append to what we already have
+            os.lseek(part_fd, offset, os.SEEK_SET)
+            write = _write_all(part_fd)
+        elif response.code == 200:
+            # either a fresh download or the server ignored the range (or the
+            # remote file changed): start again from scratch
+            os.ftruncate(part_fd, 0)
+            os.lseek(part_fd, 0, os.SEEK_SET)
+            write = _write_all(part_fd)
+            metadata = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'accept_ranges': response.headers.get('Accept-Ranges'),
+                'content_encoding': response.headers.get('Content-Encoding'),
+            }
+            _write_metadata(local_path, metadata)
+            partial_metadata = True
+
+    def on_chunk(chunk: bytes):
+        # the bodies of error responses never make it into the partial file
+        if write is not None:
+            write(chunk)
+
+    http_response: HTTPResponse
+    try:
+        try:
+            response = _ResponseHeaderCollector(on_headers, on_chunk)
+            http_response = await http_client.fetch(HTTPRequest(
+                url, headers=request_headers,
+                header_callback=_capture_errors(response, callback_errors),
+                streaming_callback=_capture_errors(
+                    response.streaming_callback, callback_errors),
+                decompress_response=False,
+                connect_timeout=CONNECT_TIMEOUT,
+                request_timeout=REQUEST_TIMEOUT), raise_error=False)
+        except Exception:
+            if callback_errors:
+                raise callback_errors[0]
+            raise
+        finally:
+            os.close(part_fd)
+        if callback_errors:
+            raise callback_errors[0]
+        if http_response.code == 304 and conditional:
+            _remove_if_exists(part_path)
+            return False
+        if http_response.code == 416 and offset:
+            # we asked for a range starting at (or past) the end of the file,
+            # so the partial file is either complete or not the remote file
+            if (response.headers.get('Content-Range') !=
+                    f'bytes */{offset}'):
+                stale = True
+        elif http_response.code not in (200, 206):
+            http_response.rethrow()
+            raise HTTPClientError(http_response.code, response=http_response)
+    except BaseException:
+        # only hang on to the partial file if we can resume it later
+        if os.path.exists(part_path) and not (
+                os.path.getsize(part_path) and
+                metadata.get('accept_ranges') == 'bytes' and
+                (metadata.get('etag') or metadata.get('last_modified'))):
+            _remove_if_exists(part_path)
+            if partial_metadata:
+                _remove_if_exists(metadata_path)
+        raise
+    if stale:
+        _remove_if_exists(part_path)
+        _remove_if_exists(metadata_path)
+        return await download_to_file(
+            url, local_path=local_path, headers=headers, segments=segments,
+            http_client=http_client)
+    await run_blocking(_finish_download, local_path, metadata)
+    return True
+
+
+class _ChunkBuffer:
+    """
+    Hand downloaded chunks over from the IOLoop to a worker thread.
+
+    streaming_callback has no way of applying backpressure, so when the
+    worker falls behind the download by more than max_size bytes, the
+    chunks that don't fit are written to a temporary file instead, and read
+    back (in order) once the worker has caught up with those in memory.
+    """
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._chunks = collections.deque()
+        self._size = 0
+        self._spill = None
+        self._spill_read = 0
+        self._spill_written = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, chunk: bytes):
+        with self._condition:
+            if (self._spill is None and
+                    self._size + len(chunk) <= self._max_size):
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            else:
+                # once spilling, everything goes to the file until the worker
+                # has read all of it, so that chunks stay in order
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile()
+                self._spill.seek(self._spill_written)
+                self._spill.write(chunk)
+                self._spill_written += len(chunk)
+            self._condition.notify()
+
+    def close(self):
+        """Signal that there are no more chunks to come."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def get(self) -> bytes:
+        """
+        Get the next chunk, waiting for it if necessary.
+
+        :return: the chunk, or None once the buffer has been closed and
+            everything put into it has been read
+        """
+        with self._condition:
+            while True:
+                if self._chunks:
+                    chunk = self._chunks.popleft()
+                    self._size -= len(chunk)
+                    return chunk
+                if self._spill is not None:
+                    if self._spill_read < self._spill_written:
+                        self._spill.seek(self._spill_read)
+                        chunk = self._spill.read(min(
+                            WRITE_BUFFER_SIZE,
+                            self._spill_written - self._spill_read))
+                        self._spill_read += len(chunk)
+                        return chunk
+                    # caught up, so go back to holding chunks in memory
+                    self._spill.close()
+                    self._spill = None
+                    self._spill_read = self._spill_written = 0
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+
+class _Base64Encoder:
+    """
+    Base64 encode data incrementally, as it arrives.
+
+    Data is encoded in multiples of 3 bytes (which encode to 4 characters
+    without any padding), so the encoded pieces can simply be joined.
+    """
+    def __init__(self):
+        self._pieces = []
+        self._pending = b''
+
+    def feed(self, data: bytes):
+        view = memoryview(data)
+        if self._pending:
+            # complete the group left over from the previous chunk
+            needed = 3 - len(self._pending)
+            self._pending += bytes(view[:needed])
+            view = view[needed:]
+            if len(self._pending) < 3:
+                return
+            self._pieces.append(
+                base64.b64encode(self._pending).decode('ascii'))
+        end = len(view) - len(view) % 3
+        if end:
+            self._pieces.append(base64.b64encode(view[:end]).decode('ascii'))
+        self._pending = bytes(view[end:])
+
+    def finish(self) -> str:
+        """Get the (padded) encoding of all of the data fed in."""
+        self._pieces.append(base64.b64encode(self._pending).decode('ascii'))
+        return ''.join(self._pieces)
+
+
+async def download_as_model(url, *,
+                            path: str,
+                            headers: dict,
+                            http_client: AsyncHTTPClient = None) -> dict:
     """
     Download a file from a remote URL as a model dictionary.
 
     :param url: remote url to download
     :param path: local path to download
     :param headers: dictionary of headers to include in request to url
+    :param http_client: client to make the request with (defaults to the
+        shared AsyncHTTPClient instance)
     :return: model dictionary
     """
     if path.endswith('/'):
@@ -36,204 +762,583 @@ def download_as_model(url, *,
     }
 
     # actually download the file
-    http_client: AsyncHTTPClient = AsyncHTTPClient()
-    http_response: HTTPResponse
-    http_response = yield http_client.fetch(url, headers=headers)
-    if ('Content-Type' in http_response.headers and
-            http_response.headers['Content-Type'].startswith("text")):
+    # the body is encoded as it arrives rather than once it has all been
+    # buffered, so that it is never held in memory both raw and encoded
+    body_chunks = []
+    body_size = 0
+    is_text = False
+    encoder = None
+
+    def on_headers(response: _ResponseHeaderCollector):
+        nonlocal is_text
+        is_text = response.headers.get('Content-Type', '').startswith("text")
+
+    def on_chunk(chunk: bytes):
+        nonlocal body_size, encoder
+        body_size += len(chunk)
+        if encoder is None and is_text and body_size < MAX_TEXT_MODEL_SIZE:
+            # this might still end up as a text model
+            body_chunks.append(chunk)
+            return
+        if encoder is None:
+            encoder = _Base64Encoder()
+            for body_chunk in body_chunks:
+                encoder.feed(body_chunk)
+            body_chunks.clear()
+        encoder.feed(chunk)
+
+    if http_client is None:
+        http_client = AsyncHTTPClient()
+    response = _ResponseHeaderCollector(on_headers, on_chunk)
+    await http_client.fetch(HTTPRequest(
+        url, headers=headers,
+        header_callback=response,
+        streaming_callback=response.streaming_callback,
+        connect_timeout=CONNECT_TIMEOUT,
+        request_timeout=REQUEST_TIMEOUT))
+    if encoder is None and is_text:
         model['format'] = "text"
         # the model format always wants text/plain
         model['mimetype'] = "text/plain"
-        model['content'] = http_response.body.decode('utf8')
+        model['content'] = b''.join(body_chunks).decode('utf8')
     else:
         # all non-text models are encoded as base64 for easier transfer over
         # the JSON based REST API
         model['format'] = "base64"
         # the model format always wants application/octet-stream
         model['mimetype'] = "application/octet-stream"
-        # b64encode returns bytes but we want a utf8 string
-        model['content'] = base64.b64encode(http_response.body).decode('utf8')
+        if encoder is None:
+            # empty body
+            encoder = _Base64Encoder()
+        model['content'] = encoder.finish()
 
     return model
 
 
-def construct_file_tree(file_paths: List[str]) -> dict:
+def _member_components(member_name: str) -> list:
     """
-    Generate a file tree dictionary from a list of file paths.
+    Split the name of a zip archive member into its path components.
 
-    All directories must be postfixed with a trailing '/' (ex. 'foo/bar' is a file
-    but 'foo/bar/' is a directory.
+    Like ZipFile.extract(), absolute paths and ".." components are dropped
+    so that members can never end up outside of the directory they are
+    extracted to.
+    """
+    return [component
+            for component in member_name.replace('\\', '/').split('/')
+            if component not in ('', '.', '..')]
 
-    This is a simple helper function and does not take into account any special
-    filesystem names (ex. . or ..).
 
-    Example. construct_file_tree(['foo/', 'foo/bar', 'eggs/one/two'])
-        {
-            'foo': {
-                'bar': None,
-            },
-            'eggs': {
-                'one': {
-                    'two': None
-                }
-            }
-        }
-    """
-    tree = dict()
-    for file_path in file_paths:
-        parent = tree
-        if file_path.endswith('/'):
-            # for directories: foo/bar/ -> ['foo/', 'bar/']
-            components = [path + '/' for path in file_path[:-1].split('/')]
-        else:
-            # foo/bar/spam -> ['foo/', 'bar/', 'spam']
-            components = [path + '/' for path in file_path.split('/')]
-            # remove trailing slash that we added
-            components[-1] = components[-1].rstrip('/')
-        for component in components:
-            if component.strip('/') == '':
-                # ignore double "/" characters
-                continue
-            if component not in parent:
-                if component.endswith('/'):
-                    parent[component] = {}
-                else:
-                    parent[component] = None
-            parent = parent[component]
-    return tree
+def _member_path(directory: str, member_name: str) -> str:
+    """Get the path that a zip archive member should be extracted to."""
+    return os.path.join(directory, *_member_components(member_name))
 
 
-def wrap_in_parent_models(model: dict) -> dict:
+def _member_data_offset(read, info: ZipInfo) -> int:
     """
-    Wrap a model in modified* Contents API format models.
+    Get the offset of the (compressed) data of a zip archive member.
 
-    For example,
-        {"path": "foo/bar",
-         "content": ...,
-         ...}
-    becomes
-        {"path": "foo",
-         "type": "directory",
-         "content": [
-            {"path": "foo/bar",
-             "content": ...,
-             ....}
-         }]}
-    :param model:
-    :return:
+    Like ZipFile.open(), the member's local file header is checked against
+    the central directory.
+
+    :param read: function taking a size and an offset, and returning that
+        many bytes of the archive from that offset (eg. os.pread)
     """
-    if model["path"].endswith("/"):
-        raise ValueError('path cannot end with slash ("/")')
-    # get all but final path components
-    # foo/bar/spam -> ["foo", "bar"]
-    parent_components = model["path"].split("/")[:-1]
-    parent = None
-    for component in parent_components:
-        child = {
-            'name': component,
-            'path': (parent["path"] + "/" + component if parent is not None
-                     else component),
-            'type': "directory",
-            'content': [],
-        }
-        if parent is not None:
-            parent['content'].append(child)
-        parent = child
-    if parent is not None:
-        parent['content'].append(model)
+    header = read(30, info.header_offset)
+    if header[:4] != b'PK\x03\x04':
+        raise BadZipFile(f'bad local file header for {info.filename}')
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    name = read(name_length, info.header_offset + 30)
+    try:
+        name = name.decode('utf8' if info.flag_bits & 0x800 else 'cp437')
+    except UnicodeDecodeError:
+        name = None
+    if name != info.orig_filename:
+        raise BadZipFile(f'file name in directory {info.orig_filename!r} '
+                         f'and header {name!r} differ')
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def _copy_stored_member(zip_path: str, info: ZipInfo,
+                        member_path: str) -> bool:
+    """
+    Copy an uncompressed zip archive member out of the archive in-kernel.
+
+    Uses copy_file_range(2), so the data never passes through userspace
+    (and filesystems that support it can share the data between the archive
+    and the extracted file instead of copying it at all). Note that, unlike
+    ZipFile, this doesn't check the member's CRC, so is only used when
+    verification has been turned off.
+
+    :return: False if the platform or filesystem doesn't support it (in
+        which case member_path may contain garbage)
+    """
+    zip_fd = os.open(zip_path, os.O_RDONLY)
+    try:
+        start = _member_data_offset(functools.partial(os.pread, zip_fd),
+                                    info)
+        fd = os.open(member_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o666)
+        try:
+            copied = 0
+            while copied < info.file_size:
+                count = os.copy_file_range(
+                    zip_fd, fd, info.file_size - copied,
+                    start + copied, copied)
+                if count == 0:
+                    raise BadZipFile(f'{info.filename} is truncated')
+                copied += count
+        finally:
+            os.close(fd)
+    except OSError as e:
+        # eg. EXDEV across filesystems on older kernels, or ENOSYS
+        if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                       errno.EOPNOTSUPP):
+            return False
+        raise
+    finally:
+        os.close(zip_fd)
+    return True
+
+
+def _map_archive(zip_fileobj) -> mmap.mmap:
+    """Memory map an open zip archive, to be read more or less in order."""
+    zip_map = mmap.mmap(zip_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        # read ahead aggressively and drop pages once they've been read
+        zip_map.madvise(mmap.MADV_SEQUENTIAL)
+    return zip_map
+
+
+def _inflate_region(zip_view: memoryview, start: int, end: int):
+    """
+    :return: the inflated data and whether it ended the deflate stream, or
+        None if the region inflates to more than MAX_INFLATED_REGION_SIZE
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    # inflate straight from the mapped archive, without copying it first
+    with zip_view[start:end] as region:
+        data = decompressor.decompress(region, MAX_INFLATED_REGION_SIZE + 1)
+    if len(data) > MAX_INFLATED_REGION_SIZE:
+        return None
+    return data, decompressor.eof
+
+
+def _inflate_parallel(zip_path: str, info: ZipInfo, member_path: str,
+                      executor: ThreadPoolExecutor, batch_size: int) -> bool:
+    """
+    Inflate a deflated zip archive member using several threads.
+
+    Deflate streams can only be split where the compressor flushed and reset
+    its dictionary (eg. pigz --independent or MiGz output), so the member is
+    split into regions at flush markers, each of which is inflated
+    independently. There's no way to tell real flush points from marker-like
+    bytes in compressed data, so any region that fails to inflate, or a CRC
+    mismatch at the end, means the member has to be inflated serially. So
+    does a region that inflates to more than MAX_INFLATED_REGION_SIZE, which
+    bounds the inflated data held in memory to batch_size regions' worth.
+
+    :return: False if the member couldn't be inflated in parallel (in which
+        case member_path may contain garbage)
+    """
+    with open(zip_path, 'rb') as zip_fileobj, \
+            _map_archive(zip_fileobj) as zip_map, \
+            memoryview(zip_map) as zip_view:
+        start = _member_data_offset(
+            lambda size, offset: zip_map[offset:offset + size], info)
+        end = start + info.compress_size
+        bounds = [start]
+        while True:
+            marker = zip_map.find(DEFLATE_FLUSH_MARKER,
+                                  bounds[-1] + DEFLATE_REGION_SIZE, end)
+            if marker == -1:
+                break
+            bounds.append(marker + len(DEFLATE_FLUSH_MARKER))
+        bounds.append(end)
+        if len(bounds) <= 2:
+            return False
+        regions = list(zip(bounds[:-1], bounds[1:]))
+
+        crc = 0
+        size = 0
+        with open(member_path, 'wb', buffering=0) as dst:
+            # inflate a batch of regions at a time, so that only a bounded
+            # amount of inflated data (at most batch_size *
+            # MAX_INFLATED_REGION_SIZE) is held in memory
+            for batch_start in range(0, len(regions), batch_size):
+                batch = regions[batch_start:batch_start + batch_size]
+                futures = [executor.submit(_inflate_region, zip_view, *region)
+                           for region in batch]
+                # every region has to be done with the mapped archive before
+                # it can be unmapped, even if one of them has already failed
+                wait(futures)
+                try:
+                    results = [future.result() for future in futures]
+                except zlib.error:
+                    return False
+                if None in results:
+                    return False
+                if hasattr(mmap, 'MADV_DONTNEED'):
+                    # this part of the archive won't be needed again
+                    page_start = batch[0][0] - batch[0][0] % mmap.PAGESIZE
+                    zip_map.madvise(mmap.MADV_DONTNEED, page_start,
+                                    batch[-1][1] - page_start)
+                for (region_start, region_end), (data, eof) in zip(batch,
+                                                                   results):
+                    # only the last region may (and must) end the stream
+                    if eof != (region_end == end):
+                        return False
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    dst.write(data)
+    return crc == info.CRC and size == info.file_size
+
+
+def _read_extraction_log(log_path: str, log_header: str) -> set:
+    """Get the names of the members which were logged as extracted."""
+    try:
+        with open(log_path, 'r', encoding='utf8') as log:
+            if log.readline().rstrip('\n') != log_header:
+                return set()
+            extracted = set()
+            for line in log:
+                try:
+                    extracted.add(json.loads(line))
+                except ValueError:
+                    # the line being written when extraction was interrupted
+                    pass
+            return extracted
+    except OSError:
+        return set()
+
+
+def extract_zip(zip_path: str, directory: str, max_workers: int = None,
+                parallel_deflate: bool = False, verify: bool = True):
+    """
+    Extract a zip file on disk into a directory.
+
+    Members are streamed straight from the archive into their destination
+    files, so no member is ever held in memory in its entirety. Files are
+    extracted concurrently by a pool of threads which each open their own
+    ZipFile (ZipFile objects can't be shared between threads); zlib releases
+    the GIL while decompressing, so this scales across cores.
+
+    The members that have been extracted are logged in a hidden file next to
+    the archive until extraction has completed, so if extraction fails part
+    way through, extracting the same archive into the same directory again
+    skips the members that were already extracted.
+
+    :param zip_path: path of the zip file to extract
+    :param directory: directory to extract into (created if necessary)
+    :param max_workers: number of extraction threads (defaults to the number
+        of CPUs)
+    :param parallel_deflate: whether to try to spread the inflation of each
+        very large member over several threads (only possible for archives
+        made by a compressor that flushes regularly, such as pigz
+        --independent)
+    :param verify: whether to check the CRC of every member (turning this
+        off allows large uncompressed members to be copied in-kernel)
+    """
+    max_workers = max_workers or os.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+    with ZipFile(zip_path) as zip_file:
+        infos = zip_file.infolist()
+
+    # the log is only valid for this exact archive and directory
+    log_path = _sidecar_path(zip_path, 'extracted')
+    zip_stat = os.stat(zip_path)
+    log_header = json.dumps({
+        'size': zip_stat.st_size,
+        'mtime_ns': zip_stat.st_mtime_ns,
+        'directory': os.path.abspath(directory),
+    })
+    extracted = _read_extraction_log(log_path, log_header)
+
+    # create the directory structure up front so that the workers only ever
+    # need to write files
+    created_dirs = {directory}
+    members = {}
+    for info in infos:
+        member_path = _member_path(directory, info.filename)
+        member_dir = member_path if info.is_dir() else (
+            os.path.dirname(member_path))
+        if member_dir not in created_dirs:
+            os.makedirs(member_dir, exist_ok=True)
+            created_dirs.add(member_dir)
+        if not info.is_dir():
+            # like ZipFile.extractall(), later duplicates of a member win
+            members[member_path] = info
+    for member_path, info in list(members.items()):
+        if info.filename in extracted:
+            del members[member_path]
+
+    local = threading.local()
+    zip_files = []
+
+    def write_member(member_path: str, info: ZipInfo):
+        if not hasattr(local, 'zip_file'):
+            local.zip_file = ZipFile(zip_path)
+            zip_files.append(local.zip_file)
+        if info.file_size <= SMALL_MEMBER_SIZE:
+            # most members of archives with lots of files are small, so
+            # keep the syscalls per file down to open, write and close
+            data = local.zip_file.read(info)
+            fd = os.open(member_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY,
+                         0o666)
+            try:
+                _write_all(fd)(data)
+            finally:
+                os.close(fd)
+            return
+        if (not verify and info.compress_type == ZIP_STORED and
+                # encrypted
+                not info.flag_bits & 0x1 and
+                hasattr(os, 'copy_file_range') and
+                _copy_stored_member(zip_path, info, member_path)):
+            return
+        with local.zip_file.open(info) as src, \
+                open(member_path, 'wb', buffering=0) as dst:
+            shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+
+    if extracted:
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND)
     else:
-        # path actually had no upper components
-        # eg. model['path'] was only "foo"
-        parent = model
-    return parent
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+        os.write(log_fd, (log_header + '\n').encode('utf8'))
 
+    def log_member(info: ZipInfo):
+        # a single O_APPEND write, so lines from different threads can't be
+        # interleaved
+        os.write(log_fd, (json.dumps(info.filename) + '\n').encode('utf8'))
 
-def unzip_as_model(zipped_model: dict,
-                   model_path: str = "unzipped",
-                   make_dirs: bool = True) -> dict:
-    """Unzip a zip file model into a modified* Contents API format.
+    def extract_member(member_path: str, info: ZipInfo):
+        write_member(member_path, info)
+        log_member(info)
 
-    All files will be encoded as base64 binary data.
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if parallel_deflate:
+                # large members get the whole pool to themselves, one at a
+                # time
+                for member_path, info in list(members.items()):
+                    if (info.compress_type == ZIP_DEFLATED and
+                            info.file_size >= PARALLEL_DEFLATE_MIN_SIZE and
+                            # encrypted
+                            not info.flag_bits & 0x1 and
+                            _inflate_parallel(zip_path, info, member_path,
+                                              executor, max_workers)):
+                        log_member(info)
+                        del members[member_path]
+            # iterate over the results so that any exceptions are raised
+            for _ in executor.map(extract_member, members.keys(),
+                                  members.values()):
+                pass
+    finally:
+        os.close(log_fd)
+        for zip_file in zip_files:
+            zip_file.close()
+    os.remove(log_path)
 
-    *modified Contents API model format:
-        the Contents API says that a directory model's contents should be
-        a list of content-free models, but here we will have content-full
-        directory models
+
+def _decode_member_name(member_name: bytes) -> str:
+    # zip member names are utf8 if the archiver says so, otherwise cp437
+    try:
+        return member_name.decode('utf8')
+    except UnicodeDecodeError:
+        return member_name.decode('cp437')
+
+
+async def download_and_extract_zip(url, *,
+                                   directory: str,
+                                   headers: dict,
+                                   http_client: AsyncHTTPClient = None):
     """
-    if zipped_model['format'] != "base64":
-        raise TypeError("in call to unzip_as_models(), model format must be "
-                        "base64")
-    # decode binary from base64 and create ZipFile instance
-    # StringIO required because ZipFile expects file-like-object
-    zip_file = ZipFile(BytesIO(
-        base64.b64decode(zipped_model["content"].encode('utf8'))))
-    # top level model
-    tree = {
-        'name': basename(model_path),
-        'path': model_path,
+    Download a zip file and extract it into a directory as it arrives.
+
+    Requires the stream-unzip package. Downloaded chunks are handed over to
+    a worker thread through a _ChunkBuffer and extracted in the order they
+    appear in the archive, so decompression overlaps with the download
+    instead of waiting for it to finish. Since the zip is only ever
+    (partially) written to disk when extraction falls behind, the download
+    can't be resumed or split into segments.
+
+    :param url: remote url of the zip file
+    :param directory: directory to extract into (created if necessary)
+    :param headers: dictionary of headers to include in request to url
+    :param http_client: client to make the request with (defaults to the
+        shared AsyncHTTPClient instance)
+    """
+    if stream_unzip is None:
+        raise RuntimeError('download_and_extract_zip() requires the '
+                           'stream-unzip package')
+    if http_client is None:
+        http_client = AsyncHTTPClient()
+    chunks = _ChunkBuffer(MAX_BUFFERED_CHUNKS_SIZE)
+    content_encoding = None
+
+    def zipped_chunks():
+        chunk = chunks.get()
+        # a server that gzips the archive even though we didn't ask it to is
+        # dealt with here, on the extraction thread (the headers have always
+        # arrived by the time the first chunk has)
+        decompressor = (zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        if content_encoding in GZIP_ENCODINGS else None)
+        while chunk is not None:
+            yield (decompressor.decompress(chunk) if decompressor is not None
+                   else chunk)
+            chunk = chunks.get()
+
+    def extract():
+        os.makedirs(directory, exist_ok=True)
+        for member_name, _, unzipped_chunks in stream_unzip(zipped_chunks()):
+            member_path = _member_path(directory,
+                                       _decode_member_name(member_name))
+            if member_name.endswith(b'/'):
+                os.makedirs(member_path, exist_ok=True)
+                for _ in unzipped_chunks:
+                    pass
+                continue
+            os.makedirs(os.path.dirname(member_path), exist_ok=True)
+            with open(member_path, 'wb',
+                      buffering=WRITE_BUFFER_SIZE) as member_file:
+                for chunk in unzipped_chunks:
+                    member_file.write(chunk)
+
+    # extract spends most of its time waiting for the download, so it gets a
+    # thread of its own rather than tying up one of _executor's (which other
+    # downloads' blocking work would then queue behind)
+    extract_executor = ThreadPoolExecutor(max_workers=1)
+    extracted = IOLoop.current().run_in_executor(extract_executor, extract)
+    # the thread exits once extraction has finished
+    extract_executor.shutdown(wait=False)
+    accepting = False
+
+    def on_headers(response: _ResponseHeaderCollector):
+        nonlocal accepting, content_encoding
+        accepting = response.code == 200
+        content_encoding = response.headers.get('Content-Encoding')
+
+    def on_chunk(chunk: bytes):
+        # stop queueing data (that would never be read) if extraction failed
+        if accepting and not extracted.done():
+            chunks.put(chunk)
+
+    response = _ResponseHeaderCollector(on_headers, on_chunk)
+    try:
+        await http_client.fetch(HTTPRequest(
+            url, headers=headers,
+            header_callback=response,
+            streaming_callback=response.streaming_callback,
+            decompress_response=False,
+            connect_timeout=CONNECT_TIMEOUT,
+            request_timeout=REQUEST_TIMEOUT))
+    except BaseException:
+        chunks.close()
+        # the extraction thread will fail on the truncated archive, but the
+        # download error is the one worth reporting
+        try:
+            await extracted
+        except Exception:
+            pass
+        raise
+    chunks.close()
+    await extracted
+
+
+def _directory_model(path: str) -> dict:
+    return {
+        'name': basename(path),
+        'path': path,
         'type': "directory",
         'content': [],
     }
 
-    # iteratively go through all files and construct models
-    for file_path in zip_file.namelist():
-        # we "descend" down a file path, so parent refers to the model of the
-        # directory containing the current component
-        # ex. if file_path="hello/world/bonjour/monde", the parent of "bonjour"
-        # is "world"
-        parent = tree
-        if file_path.endswith('/'):
-            # for directories: foo/bar/ -> ['foo/', 'bar/']
-            # note: ZipFile always gives directories with trailing slashes
-            components = [path + '/' for path in file_path[:-1].split('/')]
+
+def unzip_as_model(zip_path: str,
+                   model_path: str = "unzipped") -> dict:
+    """Unzip a zip file on disk into a modified* Contents API format.
+
+    All files will be encoded as base64 binary data. The returned model is
+    that of the top level directory of model_path, so that the model of
+    every directory leading to model_path is included.
+
+    For example, with model_path="foo/bar"
+        {"path": "foo",
+         "type": "directory",
+         "content": [
+            {"path": "foo/bar",
+             "type": "directory",
+             "content": [<unzipped files>]}
+         ]}
+
+    *modified Contents API model format:
+        the Contents API says that a directory model's contents should be
+        a list of content-free models, but here we will have content-full
+        directory models
+    """
+    if model_path.endswith("/"):
+        raise ValueError('path cannot end with slash ("/")')
+    # models of model_path and all of the directories leading to it
+    # ex. "foo/bar/spam" -> "foo" containing "foo/bar" containing
+    # "foo/bar/spam"
+    top = None
+    tree = None
+    for component in model_path.split("/"):
+        model = _directory_model(
+            tree["path"] + "/" + component if tree is not None
+            else component)
+        if tree is not None:
+            tree['content'].append(model)
         else:
-            # foo/bar/spam -> ['foo/', 'bar/', 'spam']
-            components = [path + '/' for path in file_path.split('/')]
-            # remove trailing slash that we added
-            components[-1] = components[-1].rstrip('/')
-        for component in components:
-            assert parent['type'] == "directory"
-            assert type(parent['content']) == list
-            if component.strip('/') == '':
-                # ignore double "/" characters
+            top = model
+        tree = model
+
+    # directory models indexed by path, so that files in the same directory
+    # don't each have to search their parent's contents for it
+    directories = {tree['path']: tree}
+    # file models indexed by path, so that an archive that contains the same
+    # file more than once doesn't produce (and save) a model for each copy
+    files = {}
+    with ZipFile(zip_path) as zip_file:
+        for info in zip_file.infolist():
+            components = _member_components(info.filename)
+            if not components:
                 continue
-            if component.endswith('/'):
-                # component is a directory
-
-                # don't create directories that already exist
-                # ex. when processing foo/bar/spam and foo/bar/eggs, we only
-                # create bar on the foo/bar/spam iteration and not the
-                # foo/bar/eggs iteration
-                outer_continue = False
-                for child in parent['content']:
-                    if child['name'] == component.rstrip('/'):
-                        parent = child
-                        outer_continue = True
-                        break
-                if outer_continue:
-                    continue
-                child = {
-                    'name': component.rstrip('/'),
-                    'path': os.path.join(parent['path'], component.rstrip('/')),
-                    'type': "directory",
-                    'content': list(),
-                }
-                parent['content'].append(child)
-                parent = child
-            else:
-                # component is a file
-
-                file_name = component.rstrip('/')
-                child = {
-                    'name': file_name,
-                    'path': os.path.join(parent['path'], file_name),
-                    'type': 'file',
-                    'format': "base64",
-                    'content': base64.b64encode(
-                        zip_file.read(file_path)).decode('utf8'),
-                    'mimetype': "application/octet-stream",
-                }
-                # append file to list of parent directory contents
-                parent['content'].append(child)
+            # ex. "foo/bar/spam" -> directories ["foo", "bar"], file "spam"
+            # (ZipFile always gives directories with trailing slashes)
+            file_name = None if info.is_dir() else components.pop()
+
+            # "descend" down the directories, creating the models of any that
+            # we haven't seen yet
+            parent = tree
+            for component in components:
+                path = parent['path'] + "/" + component
+                child = directories.get(path)
+                if child is None:
+                    child = _directory_model(path)
+                    parent['content'].append(child)
+                    directories[path] = child
                 parent = child
-    return wrap_in_parent_models(tree)
+
+            if file_name is not None:
+                encoder = _Base64Encoder()
+                with zip_file.open(info) as member:
+                    for chunk in iter(
+                            lambda: member.read(WRITE_BUFFER_SIZE), b''):
+                        encoder.feed(chunk)
+                path = parent['path'] + "/" + file_name
+                model = files.get(path)
+                if model is None:
+                    model = {
+                        'name': file_name,
+                        'path': path,
+                        'type': 'file',
+                        'format': "base64",
+                        'mimetype': "application/octet-stream",
+                    }
+                    parent['content'].append(model)
+                    files[path] = model
+                # later copies win, as they do with ZipFile.extractall
+                model['content'] = encoder.finish()
+    return top
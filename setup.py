@@ -7,8 +7,16 @@ setup(
     package_dir={'': '.'},
     install_requires=[
         'notebook',
-        'tornado'
+        'tornado>=5.1'
     ],
+    extras_require={
+        # keep-alive connections between downloads
+        'curl': ['pycurl'],
+        # extract zip files while they download
+        'stream': ['stream-unzip'],
+        # faster base64 encoding for non file-backed contents managers
+        'base64': ['pybase64'],
+    },
     url='https://github.com/travigd/jupyter-remotefs',
     license='All Rights Reserved',
     author='Travis G DePrato',
@@ -0,0 +1,385 @@
+import base64
+import errno
+import json
+import os
+import random
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+import tornado
+from tornado import web
+from tornado.httpclient import HTTPClientError
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from jupyter_remotefs import download
+from jupyter_remotefs.download import (create_http_client, download_as_model,
+                                       download_to_file, _Base64Encoder,
+                                       _sidecar_path)
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+CONTENT = bytes(range(256)) * 1024
+
+
+class RecordingFileHandler(web.StaticFileHandler):
+    """Serve files (with range and etag support), recording every request."""
+    def prepare(self):
+        self.settings['requests'].append(
+            (self.request.method, dict(self.request.headers)))
+
+
+class IgnoreRangeHandler(RecordingFileHandler):
+    """Advertise range support, but always send the whole file."""
+    def prepare(self):
+        super().prepare()
+        self.request.headers.pop('Range', None)
+
+
+class WeakETagHandler(RecordingFileHandler):
+    """Only give a weak validator for files."""
+    def compute_etag(self):
+        return 'W/"weak"'
+
+    def get_modified_time(self):
+        return None
+
+
+class ChangingFileHandler(RecordingFileHandler):
+    """Answer range requests from a different version of the file."""
+    def compute_etag(self):
+        if 'Range' in self.request.headers:
+            return '"changed"'
+        return super().compute_etag()
+
+
+class DownloadToFileTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.served = TemporaryDirectory()
+        self.downloads = TemporaryDirectory()
+        with open(os.path.join(self.served.name, 'file.bin'), 'wb') as f:
+            f.write(CONTENT)
+        self.requests = []
+        super().setUp()
+        self.local_path = os.path.join(self.downloads.name, 'file.bin')
+
+    def tearDown(self):
+        super().tearDown()
+        self.served.cleanup()
+        self.downloads.cleanup()
+
+    def get_app(self):
+        options = {'path': self.served.name}
+        return web.Application([
+            (r'/files/(.*)', RecordingFileHandler, options),
+            (r'/ignore-range/(.*)', IgnoreRangeHandler, options),
+            (r'/weak/(.*)', WeakETagHandler, options),
+            (r'/changing/(.*)', ChangingFileHandler, options),
+        ], requests=self.requests)
+
+    def download(self, path='/files/file.bin', **kwargs):
+        kwargs.setdefault('http_client', self.http_client)
+        return download_to_file(
+            self.get_url(path), local_path=self.local_path, headers=None,
+            **kwargs)
+
+    def assertDownloaded(self):
+        with open(self.local_path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertFalse(os.path.exists(
+            _sidecar_path(self.local_path, 'part')))
+
+    def ranges_requested(self):
+        return [headers['Range'] for method, headers in self.requests
+                if method == 'GET' and 'Range' in headers]
+
+    @gen_test
+    async def test_download(self):
+        self.assertTrue(await self.download())
+        self.assertDownloaded()
+
+    @unittest.skipIf(pycurl is None, 'pycurl is not installed')
+    @gen_test
+    async def test_curl_client(self):
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        http_client = CurlAsyncHTTPClient(force_instance=True)
+        try:
+            # the whole (small) body arrives before the curl client has
+            # handed over the headers
+            self.assertTrue(await self.download(segments=1,
+                                                http_client=http_client))
+        finally:
+            http_client.close()
+        self.assertDownloaded()
+
+    async def check_write_error(self, http_client):
+        write_all = download._write_all
+
+        def fail_second_chunk(fd):
+            write = write_all(fd)
+            chunks = []
+
+            def writer(chunk):
+                chunks.append(chunk)
+                if len(chunks) == 2:
+                    raise OSError(errno.ENOSPC, 'No space left on device')
+                write(chunk)
+            return writer
+
+        with mock.patch.object(download, '_write_all', fail_second_chunk):
+            with self.assertRaises(OSError) as context:
+                await self.download(segments=1, http_client=http_client)
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        # the truncated file is never passed off as the download
+        self.assertFalse(os.path.exists(self.local_path))
+        # and what was written before the error can still be resumed
+        self.assertTrue(await self.download(segments=1,
+                                            http_client=http_client))
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_write_error(self):
+        await self.check_write_error(self.http_client)
+
+    @unittest.skipIf(pycurl is None, 'pycurl is not installed')
+    @gen_test
+    async def test_curl_client_write_error(self):
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        # the curl client carries on with the transfer after a callback
+        # raises, so the error has to be noticed once it completes
+        http_client = CurlAsyncHTTPClient(force_instance=True)
+        try:
+            await self.check_write_error(http_client)
+        finally:
+            http_client.close()
+
+    @gen_test
+    async def test_validators_are_kept(self):
+        await self.download()
+        with open(_sidecar_path(self.local_path, 'remotefs')) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata['size'], len(CONTENT))
+        self.assertTrue(metadata['etag'])
+
+    @gen_test
+    async def test_unchanged_file_is_revalidated(self):
+        await self.download()
+        self.requests.clear()
+        self.assertFalse(await self.download())
+        self.assertDownloaded()
+        self.assertIn('If-None-Match', self.requests[-1][1])
+
+    @gen_test
+    async def test_failed_revalidation_keeps_validators(self):
+        await self.download()
+        with mock.patch.object(RecordingFileHandler, 'get',
+                               side_effect=web.HTTPError(500)):
+            with self.assertRaises(HTTPClientError):
+                await self.download()
+        self.assertDownloaded()
+        # so the next attempt can still be answered with a 304
+        self.requests.clear()
+        self.assertFalse(await self.download())
+        self.assertIn('If-None-Match', self.requests[-1][1])
+
+    @gen_test
+    async def test_modified_local_file_is_downloaded_again(self):
+        await self.download()
+        with open(self.local_path, 'ab') as f:
+            f.write(b'modified')
+        self.assertTrue(await self.download())
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_partial_download_is_resumed(self):
+        await self.download()
+        os.remove(self.local_path)
+        with open(_sidecar_path(self.local_path, 'part'), 'wb') as f:
+            f.write(CONTENT[:1000])
+        self.requests.clear()
+        self.assertTrue(await self.download(segments=1))
+        self.assertDownloaded()
+        self.assertEqual(self.ranges_requested(), ['bytes=1000-'])
+
+    async def download_from_partial(self, partial: bytes):
+        await self.download()
+        os.remove(self.local_path)
+        with open(_sidecar_path(self.local_path, 'part'), 'wb') as f:
+            f.write(partial)
+        self.requests.clear()
+        self.assertTrue(await self.download(segments=1))
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_complete_partial_download(self):
+        # answered with a 416, as the range starts at the end of the file
+        await self.download_from_partial(CONTENT)
+        self.assertEqual(len(self.requests), 1)
+
+    @gen_test
+    async def test_overlong_partial_download_is_restarted(self):
+        await self.download_from_partial(CONTENT + b'extra')
+        self.assertEqual(self.ranges_requested(),
+                         [f'bytes={len(CONTENT) + 5}-'])
+
+    @gen_test
+    async def test_stale_partial_download_is_restarted(self):
+        await self.download()
+        os.remove(self.local_path)
+        with open(_sidecar_path(self.local_path, 'part'), 'wb') as f:
+            f.write(b'x' * 1000)
+        metadata_path = _sidecar_path(self.local_path, 'remotefs')
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        with open(metadata_path, 'w') as f:
+            json.dump({**metadata, 'etag': '"stale"'}, f)
+        # the test server ignores If-Range, so has to be caught by the etag
+        self.assertTrue(await self.download(segments=1))
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_segmented_download(self):
+        with mock.patch.object(download, 'MIN_SEGMENTED_SIZE', 1024):
+            self.assertTrue(await self.download(segments=4))
+        self.assertDownloaded()
+        self.assertEqual(len(self.ranges_requested()), 4)
+
+    @gen_test
+    async def test_weak_etag_is_not_segmented(self):
+        with mock.patch.object(download, 'MIN_SEGMENTED_SIZE', 1024):
+            self.assertTrue(await self.download('/weak/file.bin'))
+        self.assertDownloaded()
+        self.assertEqual(self.ranges_requested(), [])
+
+    @gen_test
+    async def test_ignored_ranges_fall_back_to_single_stream(self):
+        with mock.patch.object(download, 'MIN_SEGMENTED_SIZE', 1024):
+            self.assertTrue(await self.download('/ignore-range/file.bin'))
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_changed_file_is_not_segmented(self):
+        with mock.patch.object(download, 'MIN_SEGMENTED_SIZE', 1024):
+            self.assertTrue(await self.download('/changing/file.bin'))
+        self.assertDownloaded()
+        # the segments were abandoned for a single request of the whole file
+        self.assertEqual(self.requests[-1][1].get('Range'), None)
+        with open(_sidecar_path(self.local_path, 'remotefs')) as f:
+            self.assertNotEqual(json.load(f)['etag'], '"changed"')
+
+    async def download_with_created_client(self):
+        http_client = create_http_client()
+        try:
+            return await self.download(segments=1, http_client=http_client)
+        finally:
+            http_client.close()
+
+    async def check_created_client_body_size(self):
+        # the client's body size limit applies to streamed bodies too
+        with mock.patch.object(download, 'MAX_BODY_SIZE', 1024):
+            with self.assertRaises(HTTPClientError):
+                await self.download_with_created_client()
+        self.assertTrue(await self.download_with_created_client())
+        self.assertDownloaded()
+
+    @gen_test
+    async def test_created_client(self):
+        with mock.patch.object(download, 'pycurl', None):
+            await self.check_created_client_body_size()
+
+    @unittest.skipIf(pycurl is None or tornado.version_info < (6, 5),
+                     'pycurl is not installed, or the curl client has no '
+                     'body size limit')
+    @gen_test
+    async def test_created_curl_client(self):
+        await self.check_created_client_body_size()
+
+    @gen_test
+    async def test_missing_directory(self):
+        self.local_path = os.path.join(self.downloads.name, 'nope', 'file')
+        with self.assertRaises(FileNotFoundError):
+            await self.download(segments=1)
+
+    @gen_test
+    async def test_http_error(self):
+        with self.assertRaises(HTTPClientError) as context:
+            await self.download('/files/nope.bin')
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(os.listdir(self.downloads.name), [])
+
+
+class Base64EncoderTest(unittest.TestCase):
+    def encode(self, *chunks) -> str:
+        encoder = _Base64Encoder()
+        for chunk in chunks:
+            encoder.feed(chunk)
+        return encoder.finish()
+
+    def test_empty(self):
+        self.assertEqual(self.encode(), '')
+        self.assertEqual(self.encode(b'', b''), '')
+
+    def test_padding(self):
+        for length in range(7):
+            data = CONTENT[:length]
+            self.assertEqual(self.encode(data),
+                             base64.b64encode(data).decode('ascii'))
+
+    def test_arbitrary_chunks(self):
+        data = os.urandom(4096)
+        for _ in range(50):
+            splits = sorted(random.randrange(len(data)) for _ in range(20))
+            chunks = [data[start:end] for start, end
+                      in zip([0] + splits, splits + [len(data)])]
+            self.assertEqual(self.encode(*chunks),
+                             base64.b64encode(data).decode('ascii'))
+
+
+class DownloadAsModelTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.served = TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.served.cleanup()
+
+    def get_app(self):
+        return web.Application([
+            (r'/(.*)', web.StaticFileHandler, {'path': self.served.name}),
+        ])
+
+    def serve(self, name: str, content: bytes):
+        with open(os.path.join(self.served.name, name), 'wb') as f:
+            f.write(content)
+        return download_as_model(
+            self.get_url('/' + name), path='dir/' + name, headers=None,
+            http_client=self.http_client)
+
+    @gen_test
+    async def test_text(self):
+        model = await self.serve('a.txt', 'caf\u00e9'.encode('utf8'))
+        self.assertEqual(model['name'], 'a.txt')
+        self.assertEqual(model['path'], 'dir/a.txt')
+        self.assertEqual(model['format'], 'text')
+        self.assertEqual(model['content'], 'caf\u00e9')
+
+    @gen_test
+    async def test_binary(self):
+        model = await self.serve('a.bin', CONTENT)
+        self.assertEqual(model['format'], 'base64')
+        self.assertEqual(base64.b64decode(model['content']), CONTENT)
+
+    @gen_test
+    async def test_large_text_is_base64(self):
+        content = b'x' * (download.MAX_TEXT_MODEL_SIZE + 1)
+        model = await self.serve('large.txt', content)
+        self.assertEqual(model['format'], 'base64')
+        self.assertEqual(base64.b64decode(model['content']), content)
+
+    @gen_test
+    async def test_empty(self):
+        model = await self.serve('empty.bin', b'')
+        self.assertEqual(model['format'], 'base64')
+        self.assertEqual(model['content'], '')
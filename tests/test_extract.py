@@ -0,0 +1,305 @@
+import base64
+import json
+import os
+import struct
+import unittest
+import zlib
+from tempfile import TemporaryDirectory
+from unittest import mock
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_STORED
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from jupyter_remotefs import download
+from jupyter_remotefs.download import (download_and_extract_zip, extract_zip,
+                                       stream_unzip, unzip_as_model,
+                                       _member_components, _sidecar_path)
+
+
+def compressible_data(size: int) -> bytes:
+    """Random data made up of four different bytes."""
+    table = bytes(b'abcd'[i % 4] for i in range(256))
+    return os.urandom(size).translate(table)
+
+
+def write_flushed_zip(zip_path: str, name: str, data: bytes, flushes: list):
+    """
+    Write a zip file with a single deflated member, compressed in
+    len(flushes) pieces with each piece followed by the given zlib flush.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    piece_size = len(data) // len(flushes)
+    pieces = []
+    for i, flush in enumerate(flushes):
+        pieces.append(compressor.compress(
+            data[i * piece_size:(i + 1) * piece_size]))
+        pieces.append(compressor.flush(flush))
+    pieces.append(compressor.compress(data[len(flushes) * piece_size:]))
+    pieces.append(compressor.flush())
+    compressed = b''.join(pieces)
+    crc = zlib.crc32(data)
+    name = name.encode('ascii')
+    local_header = struct.pack(
+        '<4sHHHHHIIIHH', b'PK\x03\x04', 20, 0, 8, 0, 0, crc,
+        len(compressed), len(data), len(name), 0) + name
+    central_header = struct.pack(
+        '<4sHHHHHHIIIHHHHHII', b'PK\x01\x02', 20, 20, 0, 8, 0, 0, crc,
+        len(compressed), len(data), len(name), 0, 0, 0, 0, 0, 0) + name
+    end = struct.pack(
+        '<4sHHHHIIH', b'PK\x05\x06', 0, 0, 1, 1, len(central_header),
+        len(local_header) + len(compressed), 0)
+    with open(zip_path, 'wb') as f:
+        f.write(local_header + compressed + central_header + end)
+
+
+class MemberComponentsTest(unittest.TestCase):
+    def test_relative(self):
+        self.assertEqual(_member_components('a/b/c.txt'),
+                         ['a', 'b', 'c.txt'])
+
+    def test_directory(self):
+        self.assertEqual(_member_components('a/b/'), ['a', 'b'])
+
+    def test_absolute(self):
+        self.assertEqual(_member_components('/etc/passwd'), ['etc', 'passwd'])
+
+    def test_parent_components(self):
+        self.assertEqual(_member_components('../../a/./../b'), ['a', 'b'])
+
+    def test_backslashes(self):
+        self.assertEqual(_member_components('..\\a\\b'), ['a', 'b'])
+
+
+class ExtractZipTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, 'archive.zip')
+        self.directory = os.path.join(self.temp_dir.name, 'extracted')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read(self, *components) -> bytes:
+        with open(os.path.join(self.directory, *components), 'rb') as f:
+            return f.read()
+
+    def test_extract(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a/b.txt', 'b')
+            zip_file.writestr('empty/', '')
+            zip_file.writestr('../escape.txt', 'escape')
+            zip_file.writestr('large.bin', os.urandom(2 << 20))
+        extract_zip(self.zip_path, self.directory)
+        self.assertEqual(self.read('a', 'b.txt'), b'b')
+        self.assertTrue(os.path.isdir(os.path.join(self.directory, 'empty')))
+        self.assertEqual(self.read('escape.txt'), b'escape')
+        self.assertEqual(len(self.read('large.bin')), 2 << 20)
+
+    def test_later_duplicates_win(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a.txt', 'first')
+            with self.assertWarns(UserWarning):
+                zip_file.writestr('a.txt', 'second')
+        extract_zip(self.zip_path, self.directory)
+        self.assertEqual(self.read('a.txt'), b'second')
+
+    def write_extraction_log(self, *member_names):
+        zip_stat = os.stat(self.zip_path)
+        log_header = json.dumps({
+            'size': zip_stat.st_size,
+            'mtime_ns': zip_stat.st_mtime_ns,
+            'directory': os.path.abspath(self.directory),
+        })
+        with open(_sidecar_path(self.zip_path, 'extracted'), 'w') as log:
+            log.write(log_header + '\n')
+            for member_name in member_names:
+                log.write(json.dumps(member_name) + '\n')
+            # interrupted part way through logging a member
+            log.write('"b.t')
+
+    def test_log_is_removed(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a.txt', 'a')
+        extract_zip(self.zip_path, self.directory)
+        self.assertFalse(os.path.exists(
+            _sidecar_path(self.zip_path, 'extracted')))
+
+    def test_resume_skips_logged_members(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a.txt', 'a')
+            zip_file.writestr('b.txt', 'b')
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'a.txt'), 'w') as f:
+            f.write('already extracted')
+        self.write_extraction_log('a.txt')
+        extract_zip(self.zip_path, self.directory)
+        self.assertEqual(self.read('a.txt'), b'already extracted')
+        self.assertEqual(self.read('b.txt'), b'b')
+        self.assertFalse(os.path.exists(
+            _sidecar_path(self.zip_path, 'extracted')))
+
+    def test_log_of_different_directory_is_ignored(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a.txt', 'a')
+        self.write_extraction_log('a.txt')
+        self.directory = os.path.join(self.temp_dir.name, 'elsewhere')
+        extract_zip(self.zip_path, self.directory)
+        self.assertEqual(self.read('a.txt'), b'a')
+
+    def test_mismatched_local_header_name(self):
+        data = os.urandom(2 << 20)
+        with ZipFile(self.zip_path, 'w', ZIP_STORED) as zip_file:
+            zip_file.writestr('a/big', data)
+        with open(self.zip_path, 'r+b') as f:
+            archive = f.read()
+            f.seek(archive.index(b'a/big'))
+            f.write(b'z')
+        with self.assertRaises(BadZipFile):
+            extract_zip(self.zip_path, self.directory, verify=False)
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'),
+                         'copy_file_range is not available')
+    def test_unverified_stored_member(self):
+        data = os.urandom(2 << 20)
+        with ZipFile(self.zip_path, 'w', ZIP_STORED) as zip_file:
+            zip_file.writestr(ZipInfo('big'), data)
+        extract_zip(self.zip_path, self.directory, verify=False)
+        self.assertEqual(self.read('big'), data)
+
+    def extract_parallel(self, **constants) -> list:
+        """
+        Extract with parallel_deflate, with the given module constants
+        patched.
+
+        :return: what each call to _inflate_parallel returned
+        """
+        results = []
+        inflate_parallel = download._inflate_parallel
+
+        def record(*args):
+            results.append(inflate_parallel(*args))
+            return results[-1]
+
+        with mock.patch.multiple(download, PARALLEL_DEFLATE_MIN_SIZE=1,
+                                 _inflate_parallel=record, **constants):
+            extract_zip(self.zip_path, self.directory, parallel_deflate=True)
+        return results
+
+    def test_parallel_deflate(self):
+        data = compressible_data(4 << 20)
+        write_flushed_zip(self.zip_path, 'big', data,
+                          [zlib.Z_FULL_FLUSH] * 15)
+        self.assertEqual(
+            self.extract_parallel(DEFLATE_REGION_SIZE=1 << 16), [True])
+        self.assertEqual(self.read('big'), data)
+
+    def test_parallel_deflate_falls_back_to_serial(self):
+        data = compressible_data(4 << 20)
+        # regions after a sync flush refer back to earlier ones, so can't be
+        # inflated independently
+        write_flushed_zip(self.zip_path, 'big', data,
+                          [zlib.Z_FULL_FLUSH, zlib.Z_SYNC_FLUSH] * 8)
+        self.assertEqual(
+            self.extract_parallel(DEFLATE_REGION_SIZE=1 << 16), [False])
+        self.assertEqual(self.read('big'), data)
+
+    def test_parallel_deflate_bounds_inflated_regions(self):
+        data = bytes(4 << 20)
+        write_flushed_zip(self.zip_path, 'big', data,
+                          [zlib.Z_FULL_FLUSH] * 3)
+        self.assertEqual(
+            self.extract_parallel(DEFLATE_REGION_SIZE=16,
+                                  MAX_INFLATED_REGION_SIZE=1 << 16),
+            [False])
+        self.assertEqual(self.read('big'), data)
+
+
+class UnzipAsModelTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, 'archive.zip')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def children(self, model: dict) -> dict:
+        """Get the contents of a directory model, by name."""
+        names = [child['name'] for child in model['content']]
+        self.assertEqual(len(names), len(set(names)), 'duplicate models')
+        return {child['name']: child for child in model['content']}
+
+    def test_model(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a/b.txt', 'b')
+            zip_file.writestr('a/c/', '')
+            zip_file.writestr('a/c/d.bin', b'\x00\x01')
+            zip_file.writestr('e.txt', 'e')
+        model = unzip_as_model(self.zip_path, model_path='x/y')
+        self.assertEqual(model['path'], 'x')
+        y = self.children(model)['y']
+        self.assertEqual(y['path'], 'x/y')
+        a = self.children(y)['a']
+        self.assertEqual(set(self.children(y)), {'a', 'e.txt'})
+        self.assertEqual(set(self.children(a)), {'b.txt', 'c'})
+        d = self.children(self.children(a)['c'])['d.bin']
+        self.assertEqual(d['path'], 'x/y/a/c/d.bin')
+        self.assertEqual(d['format'], 'base64')
+        self.assertEqual(base64.b64decode(d['content']), b'\x00\x01')
+
+    def test_duplicate_members(self):
+        with ZipFile(self.zip_path, 'w') as zip_file:
+            zip_file.writestr('a/b.txt', 'first')
+            zip_file.writestr('a/', '')
+            with self.assertWarns(UserWarning):
+                zip_file.writestr('a/b.txt', 'second')
+                zip_file.writestr('a/', '')
+        model = unzip_as_model(self.zip_path, model_path='x')
+        b = self.children(self.children(model)['a'])['b.txt']
+        self.assertEqual(base64.b64decode(b['content']), b'second')
+
+    def test_trailing_slash(self):
+        with self.assertRaises(ValueError):
+            unzip_as_model(self.zip_path, model_path='x/')
+
+
+@unittest.skipIf(stream_unzip is None, 'stream-unzip is not installed')
+class DownloadAndExtractZipTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.data = os.urandom(1 << 20)
+        with ZipFile(os.path.join(self.temp_dir.name, 'archive.zip'),
+                     'w') as zip_file:
+            zip_file.writestr('a/b.bin', self.data)
+            zip_file.writestr('c.txt', 'c')
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_dir.cleanup()
+
+    def get_app(self):
+        return web.Application([
+            (r'/(.*)', web.StaticFileHandler, {'path': self.temp_dir.name}),
+        ])
+
+    async def download(self):
+        directory = os.path.join(self.temp_dir.name, 'extracted')
+        await download_and_extract_zip(
+            self.get_url('/archive.zip'), directory=directory, headers=None,
+            http_client=self.http_client)
+        with open(os.path.join(directory, 'a', 'b.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        with open(os.path.join(directory, 'c.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'c')
+
+    @gen_test
+    async def test_download_and_extract(self):
+        await self.download()
+
+    @gen_test
+    async def test_spills_to_disk(self):
+        with mock.patch.object(download, 'MAX_BUFFERED_CHUNKS_SIZE', 1024), \
+                mock.patch.object(download.tempfile, 'TemporaryFile',
+                                  wraps=download.tempfile.TemporaryFile) \
+                as temporary_file:
+            await self.download()
+        self.assertTrue(temporary_file.called)
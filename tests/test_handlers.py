@@ -0,0 +1,171 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+from zipfile import ZipFile
+from notebook.services.contents.filemanager import FileContentsManager
+from notebook.services.contents.manager import ContentsManager
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from jupyter_remotefs.api import download as api_download
+from jupyter_remotefs.api.download import RemoteFSDownloadHandler
+
+CONTENT = bytes(range(256)) * 64
+
+
+class RecordingContentsManager(ContentsManager):
+    """A contents manager that isn't file-backed, recording what is saved."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.saved = []
+
+    def save(self, model, path=''):
+        self.saved.append(dict(model))
+        return model
+
+
+class DownloadHandlerTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.served = TemporaryDirectory()
+        self.root = TemporaryDirectory()
+        with open(os.path.join(self.served.name, 'file.bin'), 'wb') as f:
+            f.write(CONTENT)
+        with ZipFile(os.path.join(self.served.name, 'archive.zip'),
+                     'w') as zip_file:
+            zip_file.writestr('a/b.bin', CONTENT)
+            zip_file.writestr('c.txt', 'c')
+        self.contents_manager = FileContentsManager(root_dir=self.root.name)
+        super().setUp()
+        # the handler downloads with the test's client too
+        self._app.settings['remotefs_http_client'] = self.http_client
+
+    def tearDown(self):
+        super().tearDown()
+        self.served.cleanup()
+        self.root.cleanup()
+
+    def get_app(self):
+        return web.Application([
+            (r'/files/(.*)', web.StaticFileHandler,
+             {'path': self.served.name}),
+            (r'/remotefs/download', RemoteFSDownloadHandler),
+        ], contents_manager=self.contents_manager, disable_check_xsrf=True)
+
+    async def post(self, **parameters):
+        return await self.http_client.fetch(
+            self.get_url('/remotefs/download'), method='POST',
+            body=json.dumps(parameters), raise_error=False)
+
+    def read(self, *components) -> bytes:
+        with open(os.path.join(self.root.name, *components), 'rb') as f:
+            return f.read()
+
+    def use_model_contents_manager(self):
+        self.contents_manager = RecordingContentsManager()
+        self._app.settings['contents_manager'] = self.contents_manager
+
+    @gen_test
+    async def test_download(self):
+        os.mkdir(os.path.join(self.root.name, 'dir'))
+        response = await self.post(remote_url=self.get_url('/files/file.bin'),
+                                   local_path='dir/file.bin')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.read('dir', 'file.bin'), CONTENT)
+
+    @gen_test
+    async def test_download_as_model(self):
+        self.use_model_contents_manager()
+        response = await self.post(remote_url=self.get_url('/files/file.bin'),
+                                   local_path='file.bin')
+        self.assertEqual(response.code, 200)
+        [model] = self.contents_manager.saved
+        self.assertEqual(model['path'], 'file.bin')
+        self.assertEqual(model['format'], 'base64')
+
+    @gen_test
+    async def test_download_zip(self):
+        # without stream-unzip, the archive is downloaded before extraction
+        with mock.patch.object(api_download, 'stream_unzip', None):
+            response = await self.post(
+                remote_url=self.get_url('/files/archive.zip'),
+                local_path='dir', unzip='auto')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.read('dir', 'a', 'b.bin'), CONTENT)
+        self.assertEqual(self.read('dir', 'c.txt'), b'c')
+        # nothing but the extracted directory is left behind
+        self.assertEqual(os.listdir(self.root.name), ['dir'])
+
+    async def post_zip(self, **parameters):
+        """
+        Download and extract archive.zip into dir.
+
+        :return: whether it was extracted while being downloaded
+        """
+        with mock.patch.object(api_download, 'download_and_extract_zip',
+                               wraps=api_download.download_and_extract_zip) \
+                as download_and_extract_zip:
+            response = await self.post(
+                remote_url=self.get_url('/files/archive.zip'),
+                local_path='dir', unzip='zip', **parameters)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.read('dir', 'a', 'b.bin'), CONTENT)
+        self.assertEqual(self.read('dir', 'c.txt'), b'c')
+        return download_and_extract_zip.called
+
+    @unittest.skipIf(api_download.stream_unzip is None,
+                     'stream-unzip is not installed')
+    @gen_test
+    async def test_download_zip_streamed(self):
+        self.assertTrue(await self.post_zip())
+
+    @gen_test
+    async def test_extraction_options_are_not_streamed(self):
+        self.assertFalse(await self.post_zip(parallel_deflate=True))
+        self.assertFalse(await self.post_zip(verify=False))
+
+    @gen_test
+    async def test_download_zip_to_root(self):
+        with mock.patch.object(api_download, 'stream_unzip', None), \
+                mock.patch.object(api_download, 'download_to_file',
+                                  wraps=api_download.download_to_file) \
+                as download_to_file:
+            response = await self.post(
+                remote_url=self.get_url('/files/archive.zip'),
+                local_path='', unzip='zip')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.read('a', 'b.bin'), CONTENT)
+        # the archive is downloaded inside the root rather than next to it
+        zip_path = download_to_file.call_args[1]['local_path']
+        self.assertEqual(os.path.dirname(zip_path), self.root.name)
+        self.assertEqual(sorted(os.listdir(self.root.name)), ['a', 'c.txt'])
+
+    @gen_test
+    async def test_download_zip_as_models(self):
+        self.use_model_contents_manager()
+        response = await self.post(
+            remote_url=self.get_url('/files/archive.zip'),
+            local_path='x/dir', unzip='zip')
+        self.assertEqual(response.code, 200)
+        saved = [(model['type'], model['path'])
+                 for model in self.contents_manager.saved]
+        # every directory is saved (once) before its contents
+        self.assertEqual(saved, [
+            ('directory', 'x'),
+            ('directory', 'x/dir'),
+            ('directory', 'x/dir/a'),
+            ('file', 'x/dir/a/b.bin'),
+            ('file', 'x/dir/c.txt'),
+        ])
+        self.assertNotIn('content', self.contents_manager.saved[0])
+
+    @gen_test
+    async def test_malformed_request(self):
+        response = await self.post(local_path='file.bin')
+        self.assertEqual(response.code, 400)
+
+    @gen_test
+    async def test_invalid_unzip(self):
+        response = await self.post(remote_url=self.get_url('/files/file.bin'),
+                                   local_path='file.bin', unzip='tar')
+        self.assertEqual(response.code, 400)